@@ -1,13 +1,20 @@
 import os
-import requests
+import hashlib
+import asyncio
+import contextlib
+import aiohttp
 import logging
-import json
+import orjson
 import locale
+import time
+import weakref
+from typing import Optional
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 
 # --- Конфигурация ---
 load_dotenv()
@@ -15,6 +22,10 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "ВАШ_ТОКЕН_ЗДЕСЬ")
 GROUP_ID = 1671
 API_URL = f"https://cabinet.amursu.ru/public_api/group/{GROUP_ID}"
 CACHE_FILE = "schedule_cache.json"
+SCHEDULE_REFRESH_INTERVAL = 600  # секунд между фоновыми обновлениями расписания
+FETCH_BACKOFF_BASE = 30  # секунд паузы после первой ошибки API, дальше удваивается
+FETCH_BACKOFF_MAX = 600
+LAST_HASHES_LIMIT = 20  # сколько последних сообщений с кнопками помним в каждом чате
 
 # --- Новое расписание звонков ---
 NEW_SCHEDULE_TIMES = {
@@ -26,6 +37,8 @@ NEW_SCHEDULE_TIMES = {
     6: "17:20-18:50",
 }
 
+DAY_NAMES = ("Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье")
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -35,87 +48,222 @@ logger = logging.getLogger(__name__)
 
 # --- Функции для работы с API и данными ---
 
-def get_schedule_data():
+# Кэш расписания в памяти: {'schedule': результат _build_index,
+# 'from_cache': True, если последнее обновление с API не удалось,
+# 'etag'/'last_modified': заголовки последнего ответа API для условного запроса,
+# 'body_hash': хэш последнего ответа API, чтобы не переписывать файл кэша без изменений}
+_CACHE = {}
+# Текущий запрос к API: все обработчики, пришедшие во время загрузки, ждут его же
+_inflight: Optional[asyncio.Task] = None
+# Экспоненциальная пауза после ошибок API: число ошибок подряд и момент следующей попытки
+_failures = 0
+_next_attempt_at = 0.0
+
+def _write_cache_file(body):
+    with open(CACHE_FILE, 'wb') as f:
+        f.write(body)
+
+def _read_cache_file():
+    with open(CACHE_FILE, 'rb') as f:
+        return _parse_schedule(f.read())
+
+class ScheduleFormatError(Exception):
+    """Ответ API или файл кэша не удалось разобрать как расписание."""
+
+def _parse_schedule(body):
+    # Разбор JSON и построение индекса — синхронная работа, поэтому ее вызывают через asyncio.to_thread
+    try:
+        return _build_index(orjson.loads(body))
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        raise ScheduleFormatError(f"неожиданный формат расписания: {e!r}") from e
+
+async def get_schedule_data(context: CallbackContext):
     """
-    Получает данные о расписании. Сначала пытается получить свежие данные с API.
-    Если не получается, пытается загрузить из локального кэша.
+    Получает данные о расписании из памяти. Их обновляет фоновая задача refresh_loop,
+    поэтому обработчики не ждут API. Только при холодном старте, пока в памяти пусто,
+    дожидается первой загрузки (с API или из локального кэша).
     Возвращает кортеж: (данные, флаг_что_данные_из_кэша)
     """
+    if _CACHE:
+        return _CACHE['schedule'], _CACHE['from_cache']
+    return await refresh_schedule(context.bot_data['http'])
+
+async def refresh_schedule(session):
+    """Обновляет кэш в памяти. Одновременные вызовы ждут один и тот же запрос к API."""
+    global _inflight
+    if _inflight is None:
+        _inflight = asyncio.create_task(_fetch_schedule_data(session))
+        # Сбрасывает сама задача, а не вызвавший ее обработчик: его могут отменить раньше
+        _inflight.add_done_callback(_clear_inflight)
+    # shield: отмена одного обработчика не должна обрывать общий запрос
+    return await asyncio.shield(_inflight)
+
+def _clear_inflight(task):
+    global _inflight
+    if _inflight is task:
+        _inflight = None
+
+async def refresh_loop(application: Application) -> None:
+    while True:
+        try:
+            await refresh_schedule(application.bot_data['http'])
+        except Exception:
+            logger.exception("Непредвиденная ошибка при фоновом обновлении расписания.")
+        await asyncio.sleep(SCHEDULE_REFRESH_INTERVAL)
+
+def _conditional_headers():
+    # Валидаторы есть только после успешного ответа API: тогда сервер может ответить 304
+    headers = {}
+    if _CACHE.get('etag'):
+        headers['If-None-Match'] = _CACHE['etag']
+    if _CACHE.get('last_modified'):
+        headers['If-Modified-Since'] = _CACHE['last_modified']
+    return headers
+
+async def _fetch_schedule_data(session):
+    global _failures, _next_attempt_at
+    if time.monotonic() < _next_attempt_at:
+        # API недавно не отвечал: не нагружаем его и отдаем то, что уже есть
+        return (_CACHE['schedule'], True) if _CACHE else (None, False)
+
     try:
-        response = requests.get(API_URL, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        logger.info("Расписание успешно получено с API и кэш обновлен.")
-        return data, False
-
-    except requests.RequestException as e:
+        async with session.get(
+            API_URL, headers=_conditional_headers(), timeout=aiohttp.ClientTimeout(total=10)
+        ) as response:
+            if response.status == 304:
+                _failures, _next_attempt_at = 0, 0.0
+                # API подтвердил, что current_week актуален на этой неделе
+                _CACHE['schedule']['fetched_week'] = _current_iso_week()
+                _CACHE['from_cache'] = False
+                logger.info("Расписание на API не изменилось, используется копия в памяти.")
+                return _CACHE['schedule'], False
+            response.raise_for_status()
+            body = await response.read()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+        body_hash = hashlib.blake2b(body, digest_size=16).digest()
+        if _CACHE.get('body_hash') == body_hash:
+            # Сервер вернул те же байты: индекс и файл кэша уже актуальны
+            schedule = _CACHE['schedule']
+            schedule['fetched_week'] = _current_iso_week()
+        else:
+            schedule = await asyncio.to_thread(_parse_schedule, body)
+            try:
+                # Ответ API уже в JSON, поэтому в кэш пишем его как есть, без повторной сериализации
+                await asyncio.to_thread(_write_cache_file, body)
+            except OSError as write_error:
+                # Локальная ошибка диска — не сбой API: расписание в памяти все равно обновляем.
+                # Хэш не запоминаем, чтобы при следующем таком же ответе снова попробовать записать файл.
+                logger.error(f"Не удалось записать файл кэша: {write_error}")
+                body_hash = None
+        _CACHE.update(
+            schedule=schedule, from_cache=False,
+            etag=etag, last_modified=last_modified, body_hash=body_hash,
+        )
+        _failures, _next_attempt_at = 0, 0.0
+        logger.info("Расписание успешно получено с API.")
+        return _CACHE['schedule'], False
+
+    except (aiohttp.ClientError, asyncio.TimeoutError, ScheduleFormatError, OSError) as e:
+        _failures += 1
+        _next_attempt_at = time.monotonic() + min(FETCH_BACKOFF_BASE * 2 ** (_failures - 1), FETCH_BACKOFF_MAX)
+        if _CACHE:
+            logger.error(f"Ошибка при запросе к API: {e}. Продолжаю отдавать расписание из памяти.")
+            _CACHE['from_cache'] = True
+            return _CACHE['schedule'], True
+
         logger.error(f"Ошибка при запросе к API: {e}. Пытаюсь загрузить из кэша...")
         try:
-            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                cached_data = json.load(f)
+            schedule = await asyncio.to_thread(_read_cache_file)
+            _CACHE.update(schedule=schedule, from_cache=True)
             logger.info("Успешно загружено расписание из кэша.")
-            return cached_data, True
-        except (FileNotFoundError, json.JSONDecodeError):
+            return _CACHE['schedule'], True
+        except (OSError, ScheduleFormatError):
             logger.error("Файл кэша не найден или поврежден. Данных нет.")
             return None, False
 
+def _current_iso_week():
+    return datetime.now().isocalendar()[1]
+
+def _slot_time(value):
+    # "2024-09-02T08:15:00.000Z" -> "08:15"; fromisoformat заметно быстрее strptime
+    return datetime.fromisoformat(value.rstrip('Z').split('.')[0]).strftime('%H:%M')
+
+def _build_index(data):
+    """
+    Раскладывает ответ API по дням один раз на каждую загрузку:
+    lessons[(день_недели, тип_недели)] -> пары этого дня по порядку, times[номер_пары] -> "ЧЧ:ММ-ЧЧ:ММ".
+    В rendered get_schedule_for_date складывает уже собранные тексты дней.
+    fetched_week — номер недели, к которой относится current_week из ответа API.
+    """
+    lessons = {}
+    for lesson in data.get('timetable_tamplate_lines', []):
+        if not lesson.get('discipline_str'):
+            continue
+        week_types = (1, 2) if lesson['parity'] == 0 else (lesson['parity'],)
+        for week_type in week_types:
+            lessons.setdefault((lesson['weekday'], week_type), []).append(lesson)
+    for lessons_for_day in lessons.values():
+        lessons_for_day.sort(key=lambda x: x['lesson'])
+
+    # Время пар разбираем здесь, а не при каждом показе расписания
+    times = {}
+    for slot in data.get('schedule_lines', []):
+        lesson_number = slot['lesson']
+        if lesson_number in NEW_SCHEDULE_TIMES:
+            times[lesson_number] = NEW_SCHEDULE_TIMES[lesson_number]
+            continue
+        # Время с сайта разбираем только для пар, которых нет в новом расписании звонков
+        try:
+            times[lesson_number] = f"{_slot_time(slot['begin_time'])}-{_slot_time(slot['end_time'])}"
+        except (ValueError, TypeError, AttributeError) as e:
+            # Один испорченный слот не должен ломать все расписание: пары без времени просто не показываются
+            logger.warning(f"Пропускаю слот пары {lesson_number} с неверным временем: {e}")
+
+    index = {'lessons': lessons, 'times': times, 'rendered': {}, 'fetched_week': _current_iso_week()}
+    if 'current_week' in data:
+        index['current_week'] = data['current_week']
+    return index
+
 def get_week_type(schedule_data, target_date):
     if not schedule_data or 'current_week' not in schedule_data:
         return 1
     current_week_type = schedule_data['current_week']
-    today = datetime.now()
-    start_week_num = today.isocalendar()[1]
+    # current_week верен для недели загрузки, а не для сегодняшней: данные в памяти могут быть старыми
+    start_week_num = schedule_data.get('fetched_week', _current_iso_week())
     target_week_num = target_date.isocalendar()[1]
     week_diff = target_week_num - start_week_num
     if week_diff % 2 != 0:
         return 2 if current_week_type == 1 else 1
     return current_week_type
 
+_LESSON_TMPL = (
+    "🔔 **{n}. {t}**\n"
+    "📚 *Предмет:* {s}\n"
+    "🧑‍🏫 *Преподаватель:* {p}\n"
+    "🚪 *Аудитория:* {c}\n"
+)
+
 def format_day_schedule(schedule_data, day_of_week, day_name, week_type):
     week_name = f"Неделя {week_type}"
     header = f"**{day_name} ({week_name})**\n\n"
     
-    lessons_for_day = [
-        lesson for lesson in schedule_data.get('timetable_tamplate_lines', [])
-        if lesson['weekday'] == day_of_week and (lesson['parity'] == 0 or lesson['parity'] == week_type) and lesson.get('discipline_str')
-    ]
+    lessons_for_day = schedule_data['lessons'].get((day_of_week, week_type))
     if not lessons_for_day:
         return f"**{day_name} ({week_name})**\n\n✅ В этот день занятий нет."
 
-    lessons_for_day.sort(key=lambda x: x['lesson'])
-    time_slots = {slot['lesson']: slot for slot in schedule_data.get('schedule_lines', [])}
-    
-    schedule_parts = []
-    # --- НАЧАЛО ИЗМЕНЕНИЯ ---
-    # Убираем enumerate и используем настоящий номер пары из данных
-    for lesson in lessons_for_day:
-        lesson_number = lesson['lesson'] # <-- Берем реальный номер пары
-        # --- КОНЕЦ ИЗМЕНЕНИЯ ---
-        slot = time_slots.get(lesson_number)
-        if not slot: continue
-
-        time_string = NEW_SCHEDULE_TIMES.get(lesson_number)
-        if not time_string:
-            time_format = '%Y-%m-%dT%H:%M:%S.%fZ'
-            start_time = datetime.strptime(slot['begin_time'], time_format).strftime('%H:%M')
-            end_time = datetime.strptime(slot['end_time'], time_format).strftime('%H:%M')
-            time_string = f"{start_time}-{end_time}"
-
-        subject = lesson.get('discipline_str', 'Не указан')
-        teacher = lesson.get('person_str', 'Не указан')
-        classroom = lesson.get('classroom_str', 'Не указана')
-        
-        schedule_parts.append(
-            # --- ИЗМЕНЕНИЕ: Используем настоящий номер пары ---
-            f"🔔 **{lesson_number}. {time_string}**\n"
-            # --- КОНЕЦ ИЗМЕНЕНИЯ ---
-            f"📚 *Предмет:* {subject}\n"
-            f"🧑‍🏫 *Преподаватель:* {teacher}\n"
-            f"🚪 *Аудитория:* {classroom}\n"
+    time_slots = schedule_data['times']
+    # Используем настоящий номер пары из данных, чтобы были видны "окна"
+    schedule_parts = [
+        _LESSON_TMPL.format(
+            n=lesson['lesson'],
+            t=time_slots[lesson['lesson']],
+            s=lesson.get('discipline_str', 'Не указан'),
+            p=lesson.get('person_str', 'Не указан'),
+            c=lesson.get('classroom_str', 'Не указана'),
         )
-            
+        for lesson in lessons_for_day if lesson['lesson'] in time_slots
+    ]
     return header + "\n".join(schedule_parts)
 
 def get_schedule_for_date(target_date, schedule_data):
@@ -123,13 +271,19 @@ def get_schedule_for_date(target_date, schedule_data):
         return "Не удалось получить данные о расписании. Попробуйте позже."
     weekday = target_date.isoweekday()
     week_type = get_week_type(schedule_data, target_date)
-    day_name = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"][weekday-1]
-    return format_day_schedule(schedule_data, weekday, day_name, week_type)
+    # Текст дня зависит только от загруженных данных, поэтому собираем его один раз на загрузку
+    rendered = schedule_data['rendered']
+    key = (weekday, week_type)
+    if key not in rendered:
+        rendered[key] = format_day_schedule(schedule_data, weekday, DAY_NAMES[weekday-1], week_type)
+    return rendered[key]
 
 # --- Обработчики команд Telegram ---
 
+_chat_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
 async def start(update: Update, context: CallbackContext) -> None:
-    schedule_data, from_cache = get_schedule_data()
+    schedule_data, from_cache = await get_schedule_data(context)
     group_name = "ИС231"
     
     if not schedule_data:
@@ -161,9 +315,22 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
     if not update.message or not update.message.text:
         return
 
-    text = update.message.text
+    # Ответ готовим в отдельной задаче, чтобы не задерживать обработку следующих обновлений
+    context.application.create_task(
+        _run_in_chat_order(update.effective_chat.id, _reply_schedule(update, context, update.message.text)),
+        update=update,
+    )
+
+async def _run_in_chat_order(chat_id: int, coro) -> None:
+    # Ответы в одном чате идут строго по очереди, разные чаты обрабатываются параллельно.
+    # Пока задача держит блокировку, на нее есть ссылка; потом запись сама исчезает из словаря.
+    lock = _chat_locks.setdefault(chat_id, asyncio.Lock())
+    async with lock:
+        await coro
+
+async def _reply_schedule(update: Update, context: CallbackContext, text: str) -> None:
     today = datetime.now()
-    schedule_data, from_cache = get_schedule_data()
+    schedule_data, from_cache = await get_schedule_data(context)
 
     if not schedule_data:
         await update.message.reply_text("Не удалось загрузить расписаниe, и локальная копия отсутствует. Пожалуйста, попробуйте позже.")
@@ -211,7 +378,7 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
         next_monday = today + timedelta(days=days_left_in_week + 1)
         target_date = next_monday + timedelta(days=day_index - 1)
         
-    schedule_data, from_cache = get_schedule_data()
+    schedule_data, from_cache = await get_schedule_data(context)
     
     if not schedule_data:
         await query.edit_message_text(text="Не удалось загрузить расписание, и локальная копия отсутствует. Пожалуйста, попробуйте позже.")
@@ -222,8 +389,44 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
     if from_cache:
         message = "⚠️ **Внимание! Сервер АмГУ недоступен.**\nПоказываю последнее сохраненное расписание. Оно может быть неактуальным.\n\n" + message
 
-    if query.message.text != message:
+    # Сравниваем короткий хэш последнего отправленного текста, а не сами строки.
+    # Храним хэши в chat_data по id сообщения: в группе по одним кнопкам жмут разные люди.
+    message_id = query.message.message_id
+    message_hash = hashlib.blake2b(message.encode(), digest_size=8).digest()
+    last_hashes = context.chat_data.setdefault('last_hashes', {})
+    if last_hashes.get(message_id) == message_hash:
+        return
+
+    try:
         await query.edit_message_text(text=message, parse_mode=ParseMode.MARKDOWN)
+    except BadRequest as e:
+        # Хэша может не быть (например, после перезапуска), а текст уже тот же
+        if "message is not modified" not in e.message.lower():
+            raise
+    last_hashes.pop(message_id, None)
+    last_hashes[message_id] = message_hash
+    while len(last_hashes) > LAST_HASHES_LIMIT:
+        del last_hashes[next(iter(last_hashes))]
+
+# --- Жизненный цикл приложения ---
+
+async def post_init(application: Application) -> None:
+    # Одна сессия на всё время работы бота: соединения и DNS переиспользуются
+    application.bot_data['http'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300)
+    )
+    application.bot_data['refresh_task'] = asyncio.create_task(refresh_loop(application))
+
+async def post_shutdown(application: Application) -> None:
+    # Сначала останавливаем фоновое обновление и незавершенный запрос к API, потом закрываем сессию
+    for task in (application.bot_data.pop('refresh_task', None), _inflight):
+        if task:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+    session = application.bot_data.pop('http', None)
+    if session:
+        await session.close()
 
 # --- Основная функция запуска бота ---
 
@@ -240,13 +443,22 @@ def main() -> None:
         print("Ошибка: Не указан токен Telegram-бота. Укажите его в файле .env")
         return
 
-    application = Application.builder().token(TELEGRAM_TOKEN).connect_timeout(10).read_timeout(10).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .connect_timeout(10)
+        .read_timeout(10)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CallbackQueryHandler(button_callback))
 
     print("Бот запущен...")
-    application.run_polling()
+    # Длинный long-poll: соединение с Telegram держится до 50 секунд вместо частых переподключений
+    application.run_polling(poll_interval=0.0, timeout=50, bootstrap_retries=-1)
 
 if __name__ == '__main__':
     main()